@@ -21,20 +21,79 @@
 
 import os
 import pathlib
-
+import hashlib
+import importlib.util
+
+# Hilos de cómputo: estimación de núcleos físicos (sin hyperthreading)
+# para evitar sobresuscripción con lotes y capas pequeñas. También se
+# activan los kernels oneDNN (AVX-512/VNNI/BF16) en CPU.
+# Debe definirse antes de importar numpy o cualquier módulo que cargue
+# BLAS/OpenMP; si el usuario ya definió OMP_NUM_THREADS, ese valor manda
+# también para los hilos intra-op de TensorFlow.
+HILOS_ESTIMADOS = max(1, (os.cpu_count() or 2) // 2)
+os.environ.setdefault("OMP_NUM_THREADS", str(HILOS_ESTIMADOS))
+os.environ.setdefault("MKL_NUM_THREADS", str(HILOS_ESTIMADOS))
+os.environ.setdefault("TF_ENABLE_ONEDNN_OPTS", "1")
+try:
+    NUM_HILOS = max(1, int(os.environ["OMP_NUM_THREADS"]))
+except ValueError:
+    NUM_HILOS = HILOS_ESTIMADOS
+HILOS_INTER_OP = 2
+
+import joblib
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
+from scipy import sparse
+from sklearn.model_selection import StratifiedShuffleSplit
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
 
+import matplotlib
+matplotlib.use("Agg")  # backend sin interfaz: solo se exportan PNG
 import matplotlib.pyplot as plt
 
+# Auto-clustering XLA (también en CPU); debe definirse antes de importar
+# TensorFlow. Se respeta un valor ya definido en el entorno.
+os.environ.setdefault("TF_XLA_FLAGS", "--tf_xla_auto_jit=2 --tf_xla_cpu_global_jit")
+
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
 
+# Debe configurarse antes de ejecutar cualquier operación de TensorFlow
+tf.config.threading.set_intra_op_parallelism_threads(NUM_HILOS)
+tf.config.threading.set_inter_op_parallelism_threads(HILOS_INTER_OP)
+
+tf.config.optimizer.set_jit(True)
+
+
+def seleccionar_politica_precision():
+    """
+    Selecciona la política de precisión mixta de Keras:
+    - GPU disponible          -> "mixed_float16"
+    - CPU con soporte BF16    -> "mixed_bfloat16"
+    - En otro caso            -> "float32"
+    """
+    if tf.config.list_physical_devices("GPU"):
+        return "mixed_float16"
+    try:
+        flags_cpu = pathlib.Path("/proc/cpuinfo").read_text()
+    except OSError:
+        flags_cpu = ""
+    if "avx512_bf16" in flags_cpu or "amx_bf16" in flags_cpu:
+        return "mixed_bfloat16"
+    return "float32"
+
+
+POLITICA_PRECISION = seleccionar_politica_precision()
+keras.mixed_precision.set_global_policy(POLITICA_PRECISION)
+
+# Estrategia de distribución compartida por los tres modelos: réplicas en
+# espejo con varias GPU; en otro caso la estrategia por defecto (no-op).
+if len(tf.config.list_physical_devices("GPU")) > 1:
+    STRATEGY = tf.distribute.MirroredStrategy()
+else:
+    STRATEGY = tf.distribute.get_strategy()
+
 # ---------------------------------------------------------------
 # 0. Configuración básica y rutas
 # ---------------------------------------------------------------
@@ -47,7 +106,50 @@ DIR_OUTPUT = BASE_DIR / "data" / "output"
 DIR_REPORTS = BASE_DIR / "reports" / "redes_neuronales"
 
 DIR_REPORTS.mkdir(parents=True, exist_ok=True)
-print(f"Directorio de reportes: {DIR_REPORTS}\n")
+print(f"Directorio de reportes: {DIR_REPORTS}")
+print(f"Política de precisión de Keras: {POLITICA_PRECISION}")
+print(f"Hilos de TensorFlow (intra/inter-op): "
+      f"{tf.config.threading.get_intra_op_parallelism_threads()}/"
+      f"{tf.config.threading.get_inter_op_parallelism_threads()}")
+print(f"Hilos de BLAS (OMP/MKL_NUM_THREADS): "
+      f"{os.environ['OMP_NUM_THREADS']}/{os.environ['MKL_NUM_THREADS']}")
+print(f"Réplicas de la estrategia de distribución: "
+      f"{STRATEGY.num_replicas_in_sync}\n")
+
+# Partición train/test estratificada (70/30), reutilizada en todos los modelos
+SPLITTER = StratifiedShuffleSplit(n_splits=1, test_size=0.3, random_state=1234)
+
+# Figura única reutilizada para todas las curvas de entrenamiento
+FIG_CURVAS, AX_CURVAS = plt.subplots(figsize=(8, 5))
+
+# Lectura opcional con el motor de pyarrow (más rápido para CSV grandes)
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+if not HAS_PYARROW:
+    print("Nota: el paquete 'pyarrow' no está instalado.")
+    print("El CSV se leerá con el motor por defecto de pandas.\n")
+
+# Compilación opcional con numba del llenado one-hot de escenarios. Solo
+# compensa el tiempo de compilación JIT con lotes grandes; por debajo de
+# UMBRAL_FILAS_NUMBA (y sin numba) se usa indexación de numpy.
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+UMBRAL_FILAS_NUMBA = 10_000
+
+if HAS_NUMBA:
+    from numba import njit
+else:
+    print("Nota: el paquete 'numba' no está instalado.")
+    print("El llenado one-hot de escenarios usará solo numpy.\n")
+
+    def njit(*args, **kwargs):
+        """Sustituto de numba.njit que devuelve la función sin compilar."""
+        def decorador(func):
+            return func
+        return decorador
+
+# Columnas categóricas del dataset (se convierten una sola vez al cargar)
+COLS_CATEGORICAS = ["PCV2", "PCV3", "PCV5",
+                    "AREA", "DEPARTAMENTO", "cluster_k4"]
 
 # ---------------------------------------------------------------
 # 1. Carga del dataset de modelado
@@ -71,40 +173,176 @@ else:
         "Ejecutar primero 06_preparacion_modelado.R."
     )
 
-df = pd.read_csv(ruta_model_csv)
+if HAS_PYARROW:
+    df = pd.read_csv(ruta_model_csv, engine="pyarrow")
+else:
+    df = pd.read_csv(ruta_model_csv)
+
+# Tipos explícitos: categóricas como 'category' y numéricas en 32 bits
+cat_cols = [c for c in COLS_CATEGORICAS if c in df.columns]
+df[cat_cols] = df[cat_cols].astype("category")
+for col in df.select_dtypes(include="integer").columns:
+    df[col] = df[col].astype(np.int32)
+for col in df.select_dtypes(include="floating").columns:
+    df[col] = df[col].astype(np.float32)
+
+
+def hash_archivo(ruta, tam_bloque=1 << 20):
+    """
+    Calcula el hash blake2b del contenido de un archivo, leyendo por
+    bloques para no cargar el CSV completo en memoria.
+    """
+    h = hashlib.blake2b()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(tam_bloque), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+# Huella del dataset: invalida los modelos y preprocesadores guardados si
+# cambia. Implica una lectura completa adicional del CSV al inicio (coste
+# lineal en su tamaño), muy inferior a reajustar y reentrenar los modelos.
+HASH_DATASET = hash_archivo(ruta_model_csv)
+
+# Versión del formato de los archivos en caché; se incrementa cuando cambia
+# el preprocesamiento o la arquitectura para invalidar los ya guardados
+VERSION_CACHE = 2
+
 print(f"Registros en dataset de modelado: {df.shape[0]}")
 print(f"Columnas en dataset de modelado : {df.shape[1]}\n")
 
+# Categorías ordenadas de cada columna categórica y estadísticas del
+# índice de calidad, calculadas una sola vez para los escenarios
+CATS = {c: df[c].cat.categories.to_numpy() for c in cat_cols}
+
+cuantiles_icv = df["indice_calidad_vivienda"].quantile([0.0, 0.5, 0.75, 1.0])
+ICV_STATS = {
+    "min": cuantiles_icv.loc[0.0],
+    "median": cuantiles_icv.loc[0.5],
+    "q75": cuantiles_icv.loc[0.75],
+    "max": cuantiles_icv.loc[1.0],
+}
+
 # ---------------------------------------------------------------
-# 2. Funciones auxiliares
+# 2. Codificadores one-hot compartidos
 # ---------------------------------------------------------------
+# El vocabulario de cada columna es el de CATS (categorías de la columna
+# completa, calculadas una sola vez) y los codificadores se reutilizan en
+# todos los modelos:
+# - ENCODER_COMUN: bloque de categóricas común a NN1 y NN3.
+# - ENCODERS: un codificador por columna, creado al primer uso (ver
+#   obtener_encoder). Las columnas del bloque común toman su vocabulario
+#   de ENCODER_COMUN.categories_, sin recorrer de nuevo el dataset.
+print("--- Preparando codificadores one-hot compartidos ---")
+
+COLS_CAT_COMUNES = ["PCV2", "PCV3", "PCV5", "AREA", "cluster_k4"]
 
 
-def construir_preprocesador(numeric_features, categorical_features):
+def nuevo_one_hot(cols, categorias):
     """
-    Construye un ColumnTransformer que:
-    - Estandariza las variables numéricas.
-    - Aplica one-hot encoding a las categóricas.
+    OneHotEncoder para 'cols' con el vocabulario 'categorias' fijado, salida
+    dispersa float32 e ignorando categorías desconocidas (configuración
+    usada en todos los modelos). El fit se hace sobre una fila sintética:
+    con categories explícitas solo valida la configuración y registra
+    feature_names_in_.
     """
-    numeric_transformer = Pipeline(
-        steps=[
-            ("scaler", StandardScaler())
-        ]
-    )
+    fila = pd.DataFrame({c: cats[:1] for c, cats in zip(cols, categorias)})
+    return OneHotEncoder(
+        categories=list(categorias),
+        sparse_output=True,
+        dtype=np.float32,
+        handle_unknown="ignore",
+    ).fit(fila)
+
+
+if all(c in cat_cols for c in COLS_CAT_COMUNES):
+    ENCODER_COMUN = nuevo_one_hot(
+        COLS_CAT_COMUNES, [CATS[c] for c in COLS_CAT_COMUNES])
+    for col, cats in zip(ENCODER_COMUN.feature_names_in_,
+                         ENCODER_COMUN.categories_):
+        print(f" - {col}: {len(cats)} categorías (bloque común)")
+else:
+    ENCODER_COMUN = None
+    print("Advertencia: faltan columnas del bloque común; "
+          "se usarán codificadores por columna.")
+print()
 
-    categorical_transformer = Pipeline(
-        steps=[
-            ("onehot", OneHotEncoder(handle_unknown="ignore"))
-        ]
-    )
+ENCODERS = {}
 
-    preprocessor = ColumnTransformer(
-        transformers=[
-            ("num", numeric_transformer, numeric_features),
-            ("cat", categorical_transformer, categorical_features),
-        ]
-    )
-    return preprocessor
+
+def obtener_encoder(col):
+    """
+    Retorna el codificador one-hot de una columna, creándolo la primera vez
+    que se solicita. Si la columna es del bloque común reutiliza el
+    vocabulario de ENCODER_COMUN; si no, el de CATS.
+    """
+    if col not in ENCODERS:
+        if ENCODER_COMUN is not None and col in COLS_CAT_COMUNES:
+            k = list(ENCODER_COMUN.feature_names_in_).index(col)
+            cats = ENCODER_COMUN.categories_[k]
+        else:
+            cats = CATS[col]
+        ENCODERS[col] = nuevo_one_hot([col], [cats])
+        print(f" - {col}: {len(cats)} categorías")
+    return ENCODERS[col]
+
+
+def bloques_one_hot(categorical_features):
+    """
+    Agrupa las categóricas de un modelo en bloques (nombre, encoder,
+    columnas). Si el modelo incluye todo el bloque común se usa
+    ENCODER_COMUN para esas columnas (detectadas con feature_names_in_);
+    el resto usa un codificador por columna. El orden de los bloques es
+    el orden de las columnas en la matriz preprocesada.
+    """
+    bloques = []
+    restantes = list(categorical_features)
+
+    if ENCODER_COMUN is not None:
+        comunes = list(ENCODER_COMUN.feature_names_in_)
+        if set(comunes).issubset(categorical_features):
+            bloques.append(("cat_comun", ENCODER_COMUN, comunes))
+            restantes = [c for c in restantes if c not in comunes]
+
+    for col in restantes:
+        bloques.append((f"cat_{col}", obtener_encoder(col), [col]))
+    return bloques
+
+# ---------------------------------------------------------------
+# 3. Funciones auxiliares
+# ---------------------------------------------------------------
+
+
+def construir_preprocesador(numeric_features, categorical_features, X_train):
+    """
+    Construye y ajusta (con train) el preprocesador de un modelo:
+    - Un StandardScaler para las variables numéricas.
+    - Los bloques one-hot de las categóricas, reutilizando los
+      codificadores ya ajustados (ver bloques_one_hot; no se vuelven a
+      ajustar).
+    Se representa como un diccionario; ver aplicar_preprocesador.
+    """
+    scaler = StandardScaler().fit(X_train[numeric_features])
+    return {
+        "numeric_features": list(numeric_features),
+        "scaler": scaler,
+        "bloques": bloques_one_hot(categorical_features),
+    }
+
+
+def aplicar_preprocesador(preprocessor, X):
+    """
+    Transforma X en la matriz de diseño completa como una sola CSR
+    float32: primero las numéricas estandarizadas y luego cada bloque
+    one-hot (la salida del codificador ya es CSR), apilados con
+    scipy.sparse.hstack sin pasar por matrices densas intermedias.
+    """
+    num = preprocessor["scaler"].transform(
+        X[preprocessor["numeric_features"]]).astype(np.float32)
+    partes = [sparse.csr_matrix(num)]
+    for _, encoder, cols in preprocessor["bloques"]:
+        partes.append(encoder.transform(X[cols]))
+    return sparse.hstack(partes, format="csr", dtype=np.float32)
 
 
 def construir_modelo_clasificacion(input_dim, n_classes, model_name):
@@ -112,35 +350,127 @@ def construir_modelo_clasificacion(input_dim, n_classes, model_name):
     Construye una red neuronal de clasificación en Keras.
     - Si n_classes == 2: salida sigmoide (binary).
     - Si n_classes  > 2: salida softmax (multi-clase).
+    La entrada es un SparseTensor: la primera capa densa multiplica solo
+    los valores no nulos del one-hot.
+    La primera capa y la de salida se mantienen en float32 aunque la
+    política global sea de precisión mixta (el producto disperso se
+    ejecuta en float32).
+    Se compila con jit_compile=False explícito: XLA no admite operaciones
+    sobre SparseTensor (en Keras 3 el valor por defecto "auto" puede
+    activarlo en GPU). La fusión de las capas densas queda a cargo del
+    auto-clustering activado con tf.config.optimizer.set_jit.
     """
     model = keras.Sequential(name=model_name)
-    model.add(layers.Input(shape=(input_dim,), name="input_layer"))
+    model.add(layers.Input(shape=(input_dim,), sparse=True,
+                           name="input_layer"))
 
     # Capa oculta 1
-    model.add(layers.Dense(32, activation="relu", name="dense_1"))
+    model.add(layers.Dense(32, activation="relu", name="dense_1",
+                           dtype="float32"))
     model.add(layers.Dropout(0.2, name="dropout_1"))
 
     # Capa oculta 2
     model.add(layers.Dense(16, activation="relu", name="dense_2"))
 
     if n_classes == 2:
-        model.add(layers.Dense(1, activation="sigmoid", name="output"))
+        model.add(layers.Dense(1, activation="sigmoid", name="output",
+                               dtype="float32"))
         model.compile(
             optimizer="adam",
             loss="binary_crossentropy",
-            metrics=["accuracy"]
+            metrics=["accuracy"],
+            jit_compile=False,
         )
     else:
-        model.add(layers.Dense(n_classes, activation="softmax", name="output"))
+        model.add(layers.Dense(n_classes, activation="softmax", name="output",
+                               dtype="float32"))
         model.compile(
             optimizer="adam",
             loss="sparse_categorical_crossentropy",
-            metrics=["accuracy"]
+            metrics=["accuracy"],
+            jit_compile=False,
         )
 
     return model
 
 
+def csr_a_sparse_tensor(X):
+    """
+    Convierte una matriz scipy dispersa en un tf.SparseTensor float32.
+    """
+    coo = X.tocoo()
+    indices = np.column_stack((coo.row, coo.col)).astype(np.int64)
+    st = tf.SparseTensor(indices, coo.data.astype(np.float32), coo.shape)
+    return tf.sparse.reorder(st)
+
+
+def crear_dataset(X, y, batch_size, shuffle=False):
+    """
+    Construye un tf.data.Dataset en caché, con barajado opcional y
+    prefetch, para solapar el armado de lotes con el entrenamiento.
+    Las matrices scipy dispersas se alimentan como SparseTensor.
+    """
+    if sparse.issparse(X):
+        X = csr_a_sparse_tensor(X)
+    ds = tf.data.Dataset.from_tensor_slices((X, y)).cache()
+    if shuffle:
+        ds = ds.shuffle(10000, seed=1234)
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def guardar_curva_entrenamiento(history, metrica, etiqueta, model_id,
+                                dir_reports):
+    """
+    Grafica la métrica de entrenamiento vs validación sobre la figura
+    compartida (FIG_CURVAS) y la exporta como PNG. Retorna la ruta.
+    """
+    AX_CURVAS.clear()
+    AX_CURVAS.plot(history.history[metrica], label="Entrenamiento")
+    AX_CURVAS.plot(history.history[f"val_{metrica}"], label="Validación")
+    AX_CURVAS.set_xlabel("Época")
+    AX_CURVAS.set_ylabel(etiqueta)
+    AX_CURVAS.set_title(f"{etiqueta} entrenamiento/validación - {model_id}")
+    AX_CURVAS.legend()
+    AX_CURVAS.grid(True)
+    ruta = dir_reports / f"{model_id}_{metrica}.png"
+    FIG_CURVAS.savefig(ruta, dpi=150, bbox_inches="tight")
+    return ruta
+
+
+def cargar_preprocesador_cache(ruta, ruta_model, clave):
+    """
+    Carga el preprocesador y el class_mapping de una ejecución previa.
+    Retorna None si falta el archivo o el modelo guardado, o si la clave
+    (hash del dataset, versiones, target, variables y parámetros de
+    entrenamiento) no coincide.
+    """
+    if not ruta.exists() or not ruta_model.exists():
+        return None
+    cache = joblib.load(ruta)
+    if cache.get("clave") != clave:
+        print(f"Preprocesador en caché desactualizado: {ruta}")
+        return None
+    print(f"Preprocesador reutilizado desde: {ruta}")
+    return cache
+
+
+def guardar_preprocesador_cache(ruta, clave, preprocessor, class_mapping):
+    """
+    Guarda el preprocesador ajustado y el class_mapping junto con su
+    clave de validez.
+    """
+    joblib.dump(
+        {
+            "clave": clave,
+            "preprocessor": preprocessor,
+            "class_mapping": class_mapping,
+        },
+        ruta,
+        compress=3,
+    )
+    print(f"Preprocesador guardado en: {ruta}")
+
+
 def entrenar_modelo_nn(
     df,
     target_col,
@@ -159,10 +489,13 @@ def entrenar_modelo_nn(
     - Limpieza de filas con NA.
     - Train/test split.
     - Preprocesamiento (escala + one-hot).
-    - Entrenamiento de la NN.
+    - Entrenamiento de la NN (con early stopping sobre val_loss) y
+      gráficas de entrenamiento.
     - Evaluación en test.
-    - Gráficas de entrenamiento.
     - Retorno de modelo, preprocesador y otros elementos.
+    Si el dataset y la configuración no cambiaron desde la ejecución
+    anterior, se reutilizan el preprocesador y el modelo guardados y se
+    omiten el ajuste y el entrenamiento.
     """
     print("------------------------------------------------------------")
     print(f" Entrenando modelo de red neuronal: {model_id}")
@@ -177,121 +510,184 @@ def entrenar_modelo_nn(
             f"{', '.join(faltantes)}"
         )
 
-    # Subconjunto
-    data_sub = df[cols_necesarias].copy()
-
-    # Eliminar filas con NA en target o predictores
-    data_sub = data_sub.dropna(subset=cols_necesarias)
-    print(f"Observaciones completas para {model_id}: {data_sub.shape[0]}")
+    # Filas sin NA en target ni predictores. La máscara se arma columna a
+    # columna y se aplica directamente al target y a X, sin un DataFrame
+    # intermedio con todas las columnas.
+    completas = np.logical_and.reduce(
+        [df[c].notna().to_numpy() for c in cols_necesarias])
+    print(f"Observaciones completas para {model_id}: {int(completas.sum())}")
 
     # Codificar target como categoría (para multi-clase) o binaria
     # Se guardan las categorías originales para interpretaciones.
-    y_cat = data_sub[target_col].astype("category")
+    y_cat = df.loc[completas, target_col].astype("category")
     class_mapping = dict(enumerate(y_cat.cat.categories))
+    n_classes = len(y_cat.cat.categories)
     y = y_cat.cat.codes.values
 
-    X = data_sub[predictors].copy()
+    X = df.loc[completas, predictors]
 
-    # Train/test split
-    X_train, X_test, y_train, y_test = train_test_split(
-        X,
-        y,
-        test_size=0.3,
-        random_state=1234,
-        stratify=y,
-    )
+    # Train/test split estratificado sobre los códigos enteros del target
+    train_idx, test_idx = next(SPLITTER.split(np.zeros(len(y)), y))
+    X_train, X_test = X.iloc[train_idx], X.iloc[test_idx]
+    y_train, y_test = y[train_idx], y[test_idx]
 
     print(f"Tamaño entrenamiento: {X_train.shape[0]}")
     print(f"Tamaño prueba       : {X_test.shape[0]}")
 
-    # Preprocesador
-    preprocessor = construir_preprocesador(
-        numeric_features, categorical_features)
+    # Reutilización: si el dataset y la configuración del modelo no
+    # cambiaron, se cargan el preprocesador y el modelo de una ejecución
+    # previa y se omiten el ajuste y el entrenamiento
+    ruta_preproc = dir_reports / f"{model_id}_preproc.joblib"
+    ruta_model = dir_reports / f"{model_id}_model.keras"
+    clave_preproc = {
+        "version_cache": VERSION_CACHE,
+        "hash_dataset": HASH_DATASET,
+        "keras": keras.__version__,
+        "politica_precision": POLITICA_PRECISION,
+        "random_state_split": SPLITTER.random_state,
+        "target": target_col,
+        "numeric_features": list(numeric_features),
+        "categorical_features": list(categorical_features),
+        "epochs": epochs,
+        "batch_size": batch_size,
+    }
+    cache = cargar_preprocesador_cache(ruta_preproc, ruta_model, clave_preproc)
+
+    if cache is not None:
+        preprocessor = cache["preprocessor"]
+        # Se usan los codificadores compartidos en memoria (mismo
+        # vocabulario: viene de CATS y la clave valida el dataset)
+        preprocessor["bloques"] = bloques_one_hot(categorical_features)
+        class_mapping = cache["class_mapping"]
+    else:
+        preprocessor = construir_preprocesador(
+            numeric_features, categorical_features, X_train)
+
+    # Etiquetas indexables por código de clase (categorias_target[codes])
+    categorias_target = np.array(
+        [class_mapping[i] for i in range(n_classes)], dtype=object)
 
-    # Ajustar preprocesador con train
-    X_train_proc = preprocessor.fit_transform(X_train)
-    X_test_proc = preprocessor.transform(X_test)
+    # Matriz CSR float32 (el bloque one-hot es mayoritariamente ceros)
+    X_test_proc = aplicar_preprocesador(preprocessor, X_test)
+    y_train = y_train.astype(np.int32)
+    y_test = y_test.astype(np.int32)
 
-    input_dim = X_train_proc.shape[1]
-    n_classes = len(np.unique(y_train))
+    input_dim = X_test_proc.shape[1]
 
     print(
         f"Dimensión de entrada (features tras preprocesamiento): {input_dim}")
     print(f"Número de clases en el target: {n_classes}")
 
-    # Construcción del modelo
-    model = construir_modelo_clasificacion(
-        input_dim=input_dim,
-        n_classes=n_classes,
-        model_name=model_id
-    )
+    # El lote global crece con el número de réplicas
+    batch_size = batch_size * STRATEGY.num_replicas_in_sync
 
-    print("\nResumen de la arquitectura de la red:")
-    model.summary(print_fn=lambda x: print("  " + x))
-
-    # Entrenamiento
-    print("\n--- Entrenando la red neuronal ---")
-    history = model.fit(
-        X_train_proc,
-        y_train,
-        validation_split=0.2,
-        epochs=epochs,
-        batch_size=batch_size,
-        verbose=1,
-    )
+    if cache is not None:
+        with STRATEGY.scope():
+            model = keras.models.load_model(ruta_model)
+        print(f"Modelo reutilizado desde: {ruta_model}")
+        print("Se omite el entrenamiento (curvas de la ejecución previa).")
+    else:
+        X_train_proc = aplicar_preprocesador(preprocessor, X_train)
+
+        # Construcción del modelo dentro de la estrategia de distribución
+        with STRATEGY.scope():
+            model = construir_modelo_clasificacion(
+                input_dim=input_dim,
+                n_classes=n_classes,
+                model_name=model_id,
+            )
+
+        print("\nResumen de la arquitectura de la red:")
+        model.summary(print_fn=lambda x: print("  " + x))
+
+        # Entrenamiento
+        print("\n--- Entrenando la red neuronal ---")
+        # Validación: último 20% del conjunto de entrenamiento (equivalente
+        # a validation_split=0.2, que no admite tf.data.Dataset)
+        n_fit = int(X_train_proc.shape[0] * 0.8)
+        train_ds = crear_dataset(
+            X_train_proc[:n_fit], y_train[:n_fit], batch_size, shuffle=True)
+        val_ds = crear_dataset(
+            X_train_proc[n_fit:], y_train[n_fit:], batch_size)
+
+        # 'epochs' es un máximo: se detiene cuando val_loss deja de mejorar
+        # y se restauran los mejores pesos
+        callbacks = [
+            keras.callbacks.EarlyStopping(
+                monitor="val_loss", patience=5, restore_best_weights=True),
+            keras.callbacks.ReduceLROnPlateau(
+                monitor="val_loss", patience=3, factor=0.5),
+            keras.callbacks.TerminateOnNaN(),
+        ]
+
+        history = model.fit(
+            train_ds,
+            validation_data=val_ds,
+            epochs=epochs,
+            callbacks=callbacks,
+            verbose=1,
+        )
+        print(f"Épocas entrenadas: {len(history.history['loss'])} de {epochs}")
+
+        # Gráficas de entrenamiento vs validación
+        print("--- Generando gráficas de entrenamiento ---")
+        ruta_acc = guardar_curva_entrenamiento(
+            history, "accuracy", "Accuracy", model_id, dir_reports)
+        ruta_loss = guardar_curva_entrenamiento(
+            history, "loss", "Loss", model_id, dir_reports)
+
+        print("Gráficas guardadas en:")
+        print(f" - {ruta_acc}")
+        print(f" - {ruta_loss}\n")
+
+        # Guardar modelo y, después, el preprocesador (la caché solo es
+        # válida si ambos archivos existen)
+        model.save(ruta_model)
+        print(f"Modelo guardado en: {ruta_model}")
+        guardar_preprocesador_cache(
+            ruta_preproc, clave_preproc, preprocessor, class_mapping)
+        print()
 
     # Evaluación en test
     print("\n--- Evaluación en conjunto de prueba ---")
-    test_loss, test_acc = model.evaluate(X_test_proc, y_test, verbose=0)
+    test_ds = crear_dataset(X_test_proc, y_test, batch_size)
+    test_loss, test_acc = model.evaluate(test_ds, verbose=0)
     print(f"Loss en prueba    : {test_loss:.4f}")
     print(f"Accuracy en prueba: {test_acc:.4f}")
     print("Nota: comparar este accuracy con el del árbol de decisión correspondiente.\n")
 
-    # Gráficas de entrenamiento vs validación
-    print("--- Generando gráficas de entrenamiento ---")
-    # Accuracy
-    plt.figure(figsize=(8, 5))
-    plt.plot(history.history["accuracy"], label="Entrenamiento")
-    plt.plot(history.history["val_accuracy"], label="Validación")
-    plt.xlabel("Época")
-    plt.ylabel("Accuracy")
-    plt.title(f"Accuracy entrenamiento/validación - {model_id}")
-    plt.legend()
-    plt.grid(True)
-    ruta_acc = DIR_REPORTS / f"{model_id}_accuracy.png"
-    plt.savefig(ruta_acc, dpi=150, bbox_inches="tight")
-    plt.close()
-
-    # Loss
-    plt.figure(figsize=(8, 5))
-    plt.plot(history.history["loss"], label="Entrenamiento")
-    plt.plot(history.history["val_loss"], label="Validación")
-    plt.xlabel("Época")
-    plt.ylabel("Loss")
-    plt.title(f"Loss entrenamiento/validación - {model_id}")
-    plt.legend()
-    plt.grid(True)
-    ruta_loss = DIR_REPORTS / f"{model_id}_loss.png"
-    plt.savefig(ruta_loss, dpi=150, bbox_inches="tight")
-    plt.close()
-
-    print("Gráficas guardadas en:")
-    print(f" - {ruta_acc}")
-    print(f" - {ruta_loss}\n")
-
-    # Guardar modelo
-    ruta_model = DIR_REPORTS / f"{model_id}_model.keras"
-    model.save(ruta_model)
-    print(f"Modelo guardado en: {ruta_model}\n")
+    # Datos del preprocesador para construir entradas sin pasar por pandas
+    scaler = preprocessor["scaler"]
+    categorias = {}
+    for _, encoder, cols in preprocessor["bloques"]:
+        for col, cats in zip(cols, encoder.categories_):
+            categorias[col] = cats
+    # Columna inicial de cada bloque one-hot (tras las numéricas)
+    tamanos_cat = [len(cats) for cats in categorias.values()]
+    offsets_cat = (len(numeric_features)
+                   + np.concatenate(([0], np.cumsum(tamanos_cat)[:-1])))
+
+    # Función de predicción compilada una sola vez con firma fija: se
+    # reutiliza en cada llamada sin volver a trazar el grafo
+    @tf.function(input_signature=[
+        tf.SparseTensorSpec([None, input_dim], tf.float32)])
+    def predict_fn(x):
+        return model(x, training=False)
 
     return {
         "model": model,
+        "predict_fn": predict_fn,
         "preprocessor": preprocessor,
+        "numeric_features": numeric_features,
+        "scaler": scaler,
+        "categorias": categorias,
+        "offsets_cat": offsets_cat.astype(np.int64),
         "X_train": X_train,
         "X_test": X_test,
         "y_train": y_train,
         "y_test": y_test,
         "class_mapping": class_mapping,
+        "categorias_target": categorias_target,
         "test_accuracy": test_acc,
     }
 
@@ -300,20 +696,98 @@ def construir_df_escenarios(predictors, escenarios_dict):
     """
     Construye un DataFrame con filas que representan los diferentes
     escenarios, cada uno con valores para las columnas de 'predictors'.
+    Se usa únicamente para reportar las predicciones.
     escenarios_dict:
         {
           "escenario_1": {var1: val1, var2: val2, ...},
           ...
         }
     """
-    rows = []
-    for nombre_esc, valores in escenarios_dict.items():
-        fila = {p: valores.get(p, np.nan) for p in predictors}
-        fila["escenario"] = nombre_esc
-        rows.append(fila)
-    df_esc = pd.DataFrame(rows)
-    cols = ["escenario"] + predictors
-    return df_esc[cols]
+    df_esc = pd.DataFrame.from_dict(
+        escenarios_dict, orient="index").reindex(columns=predictors)
+    df_esc.insert(0, "escenario", df_esc.index)
+    return df_esc.reset_index(drop=True)
+
+
+@njit(cache=True)
+def llenar_one_hot(codes, offsets, out):
+    """
+    Escribe 1.0 en out[fila, offsets[col] + codes[fila, col]] para cada
+    par (fila, col). Los códigos negativos (categoría desconocida o
+    faltante) se omiten.
+    """
+    for fila in range(codes.shape[0]):
+        for col in range(codes.shape[1]):
+            code = codes[fila, col]
+            if code >= 0:
+                out[fila, offsets[col] + code] = 1.0
+
+
+def marcar_one_hot(codes, offsets, out):
+    """
+    Marca las posiciones one-hot de 'codes' en 'out'. Con numba y al menos
+    UMBRAL_FILAS_NUMBA filas usa llenar_one_hot; en otro caso (p. ej. los
+    pocos escenarios de este script) una asignación con indexación de
+    numpy, que evita pagar la compilación JIT.
+    """
+    if HAS_NUMBA and codes.shape[0] >= UMBRAL_FILAS_NUMBA:
+        llenar_one_hot(codes, offsets, out)
+        return
+    filas, cols = np.nonzero(codes >= 0)
+    out[filas, offsets[cols] + codes[filas, cols]] = 1.0
+
+
+def codificar_categorias(valores, cats):
+    """
+    Devuelve el código entero (posición en 'cats', ordenadas) de cada
+    valor, o -1 si el valor falta o no es una categoría conocida.
+    """
+    codes = np.full(len(valores), -1, dtype=np.int32)
+    for i, valor in enumerate(valores):
+        if valor is None:
+            continue
+        idx = np.searchsorted(cats, valor)
+        if idx < len(cats) and cats[idx] == valor:
+            codes[i] = idx
+    return codes
+
+
+def construir_matriz_escenarios(info_modelo, escenarios_dict):
+    """
+    Construye directamente la matriz de entrada (ya preprocesada) de los
+    escenarios, sin pasar por pandas ni por aplicar_preprocesador:
+    - Numéricas: se estandarizan con mean_/scale_ del scaler ajustado.
+    - Categóricas: cada valor se codifica como entero con np.searchsorted
+      sobre las categorías del codificador y marcar_one_hot marca 1.0 en
+      su posición. Las categorías desconocidas quedan en ceros
+      (handle_unknown="ignore").
+    El orden de las columnas es el mismo de aplicar_preprocesador:
+    primero las numéricas y luego cada bloque one-hot.
+    """
+    numeric_features = info_modelo["numeric_features"]
+    categorias = info_modelo["categorias"]
+    scaler = info_modelo["scaler"]
+
+    escenarios = list(escenarios_dict.values())
+    n_esc = len(escenarios)
+    n_num = len(numeric_features)
+    input_dim = n_num + sum(len(cats) for cats in categorias.values())
+
+    X_out = np.zeros((n_esc, input_dim), dtype=np.float32)
+
+    valores_num = np.array(
+        [[esc.get(p, np.nan) for p in numeric_features] for esc in escenarios],
+        dtype=np.float32,
+    ).reshape(n_esc, n_num)
+    X_out[:, :n_num] = (valores_num - scaler.mean_) / scaler.scale_
+
+    codes = np.empty((n_esc, len(categorias)), dtype=np.int32)
+    for j, (col, cats) in enumerate(categorias.items()):
+        codes[:, j] = codificar_categorias(
+            [esc.get(col) for esc in escenarios], cats)
+    marcar_one_hot(codes, info_modelo["offsets_cat"], X_out)
+
+    return X_out
 
 
 def predecir_escenarios(
@@ -330,28 +804,23 @@ def predecir_escenarios(
     print(f"--- Predicciones por escenarios para {model_id} ---")
     df_esc = construir_df_escenarios(predictors, escenarios_dict)
 
-    # Separar columna escenario
-    escenario_col = df_esc["escenario"].copy()
-    X_esc = df_esc.drop(columns=["escenario"])
-
-    # Transformar con el preprocesador ajustado
-    X_esc_proc = info_modelo["preprocessor"].transform(X_esc)
+    # Matriz de entrada construida directamente en numpy
+    X_esc_proc = construir_matriz_escenarios(info_modelo, escenarios_dict)
 
     # Predicciones
-    model = info_modelo["model"]
     class_mapping = info_modelo["class_mapping"]
+    categorias_target = info_modelo["categorias_target"]
 
-    y_proba = model.predict(X_esc_proc)
+    # Función tf.function cacheada en info_modelo: evita el Dataset y los
+    # callbacks por lote de model.predict y el retrazado entre llamadas
+    X_tf = tf.sparse.from_dense(
+        tf.convert_to_tensor(X_esc_proc.astype(np.float32, copy=False)))
+    y_proba = info_modelo["predict_fn"](X_tf).numpy()
     if y_proba.shape[1] == 1:
         # Caso binario: una sola probabilidad (clase positiva)
         y_pred_class = (y_proba[:, 0] >= 0.5).astype(int)
-        # Reconstruir etiquetas originales
-        inv_map = {v: k for k, v in class_mapping.items()}
-        # Asegurar que 0/1 correspondan a las posiciones correctas
-        # y_pred_label = [class_mapping.get(c, c) for c in y_pred_class]
-        y_pred_label = [
-            class_mapping.get(c, str(c)) for c in y_pred_class
-        ]
+        # Reconstruir etiquetas originales (códigos 0/1 -> categorías)
+        y_pred_label = categorias_target[y_pred_class]
 
         df_out = df_esc.copy()
         df_out["clase_predicha_cod"] = y_pred_class
@@ -360,7 +829,7 @@ def predecir_escenarios(
     else:
         # Multi-clase
         y_pred_class = np.argmax(y_proba, axis=1)
-        y_pred_label = [class_mapping.get(c, str(c)) for c in y_pred_class]
+        y_pred_label = categorias_target[y_pred_class]
 
         df_out = df_esc.copy()
         df_out["clase_predicha_cod"] = y_pred_class
@@ -380,7 +849,7 @@ def predecir_escenarios(
 
 
 # ===============================================================
-# 3. MODELO NN1 — Target: indice_calidad_vivienda_cat
+# 4. MODELO NN1 — Target: indice_calidad_vivienda_cat
 # ===============================================================
 print("==============================================================")
 print(" MODELO NN1 — Target: indice_calidad_vivienda_cat")
@@ -412,33 +881,33 @@ info_nn1 = entrenar_modelo_nn(
 # Escenarios NN1 (vivienda de baja, media y alta calidad esperada)
 escenarios_nn1 = {
     "esc_1_materiales_muy_precarios_sin_servicios": {
-        "PCV2": df["PCV2"].dropna().astype("category").cat.categories[0],
-        "PCV3": df["PCV3"].dropna().astype("category").cat.categories[0],
-        "PCV5": df["PCV5"].dropna().astype("category").cat.categories[0],
+        "PCV2": CATS["PCV2"][0],
+        "PCV3": CATS["PCV3"][0],
+        "PCV5": CATS["PCV5"][0],
         "agua_mejorada": 0,
         "saneamiento_mejorado": 0,
         "electricidad": 0,
-        "AREA": df["AREA"].dropna().astype("category").cat.categories[0],
+        "AREA": CATS["AREA"][0],
         "cluster_k4": 1,
     },
     "esc_2_materiales_intermedios_con_algunos_servicios": {
-        "PCV2": df["PCV2"].dropna().astype("category").cat.categories[min(1, len(df["PCV2"].dropna().astype("category").cat.categories)-1)],
-        "PCV3": df["PCV3"].dropna().astype("category").cat.categories[min(1, len(df["PCV3"].dropna().astype("category").cat.categories)-1)],
-        "PCV5": df["PCV5"].dropna().astype("category").cat.categories[min(1, len(df["PCV5"].dropna().astype("category").cat.categories)-1)],
+        "PCV2": CATS["PCV2"][min(1, len(CATS["PCV2"]) - 1)],
+        "PCV3": CATS["PCV3"][min(1, len(CATS["PCV3"]) - 1)],
+        "PCV5": CATS["PCV5"][min(1, len(CATS["PCV5"]) - 1)],
         "agua_mejorada": 1,
         "saneamiento_mejorado": 0,
         "electricidad": 1,
-        "AREA": df["AREA"].dropna().astype("category").cat.categories[0],
+        "AREA": CATS["AREA"][0],
         "cluster_k4": 2,
     },
     "esc_3_materiales_buenos_con_todos_los_servicios": {
-        "PCV2": df["PCV2"].dropna().astype("category").cat.categories[-1],
-        "PCV3": df["PCV3"].dropna().astype("category").cat.categories[-1],
-        "PCV5": df["PCV5"].dropna().astype("category").cat.categories[-1],
+        "PCV2": CATS["PCV2"][-1],
+        "PCV3": CATS["PCV3"][-1],
+        "PCV5": CATS["PCV5"][-1],
         "agua_mejorada": 1,
         "saneamiento_mejorado": 1,
         "electricidad": 1,
-        "AREA": df["AREA"].dropna().astype("category").cat.categories[-1],
+        "AREA": CATS["AREA"][-1],
         "cluster_k4": 3,
     },
 }
@@ -452,7 +921,7 @@ predecir_escenarios(
 )
 
 # ===============================================================
-# 4. MODELO NN2 — Target: n_emigrantes_cat
+# 5. MODELO NN2 — Target: n_emigrantes_cat
 # ===============================================================
 print("==============================================================")
 print(" MODELO NN2 — Target: n_emigrantes_cat")
@@ -485,20 +954,20 @@ info_nn2 = entrenar_modelo_nn(
 # Escenarios NN2 (hogares con distinto tamaño y calidad)
 escenarios_nn2 = {
     "esc_1_hogar_pequeno_alta_calidad": {
-        "AREA": df["AREA"].dropna().astype("category").cat.categories[-1],
-        "indice_calidad_vivienda": df["indice_calidad_vivienda"].max(),
+        "AREA": CATS["AREA"][-1],
+        "indice_calidad_vivienda": ICV_STATS["max"],
         "n_personas": 3,
         "cluster_k4": 1,
     },
     "esc_2_hogar_grande_baja_calidad": {
-        "AREA": df["AREA"].dropna().astype("category").cat.categories[0],
-        "indice_calidad_vivienda": df["indice_calidad_vivienda"].min(),
+        "AREA": CATS["AREA"][0],
+        "indice_calidad_vivienda": ICV_STATS["min"],
         "n_personas": 8,
         "cluster_k4": 2,
     },
     "esc_3_hogar_mediano_calidad_media": {
-        "AREA": df["AREA"].dropna().astype("category").cat.categories[0],
-        "indice_calidad_vivienda": df["indice_calidad_vivienda"].median(),
+        "AREA": CATS["AREA"][0],
+        "indice_calidad_vivienda": ICV_STATS["median"],
         "n_personas": 5,
         "cluster_k4": 3,
     },
@@ -513,7 +982,7 @@ predecir_escenarios(
 )
 
 # ===============================================================
-# 5. MODELO NN3 — Target: agua_mejorada (binario)
+# 6. MODELO NN3 — Target: agua_mejorada (binario)
 # ===============================================================
 print("==============================================================")
 print(" MODELO NN3 — Target: agua_mejorada")
@@ -548,34 +1017,34 @@ info_nn3 = entrenar_modelo_nn(
 # Escenarios NN3 (acceso a agua esperado vs no esperado)
 escenarios_nn3 = {
     "esc_1_vivienda_rural_precaria": {
-        "PCV2": df["PCV2"].dropna().astype("category").cat.categories[0],
-        "PCV3": df["PCV3"].dropna().astype("category").cat.categories[0],
-        "PCV5": df["PCV5"].dropna().astype("category").cat.categories[0],
-        "DEPARTAMENTO": df["DEPARTAMENTO"].dropna().astype("category").cat.categories[0],
-        "AREA": df["AREA"].dropna().astype("category").cat.categories[0],
+        "PCV2": CATS["PCV2"][0],
+        "PCV3": CATS["PCV3"][0],
+        "PCV5": CATS["PCV5"][0],
+        "DEPARTAMENTO": CATS["DEPARTAMENTO"][0],
+        "AREA": CATS["AREA"][0],
         "cluster_k4": 1,
         "n_personas": 7,
-        "indice_calidad_vivienda": df["indice_calidad_vivienda"].min(),
+        "indice_calidad_vivienda": ICV_STATS["min"],
     },
     "esc_2_vivienda_urbana_mejor_calidad": {
-        "PCV2": df["PCV2"].dropna().astype("category").cat.categories[-1],
-        "PCV3": df["PCV3"].dropna().astype("category").cat.categories[-1],
-        "PCV5": df["PCV5"].dropna().astype("category").cat.categories[-1],
-        "DEPARTAMENTO": df["DEPARTAMENTO"].dropna().astype("category").cat.categories[-1],
-        "AREA": df["AREA"].dropna().astype("category").cat.categories[-1],
+        "PCV2": CATS["PCV2"][-1],
+        "PCV3": CATS["PCV3"][-1],
+        "PCV5": CATS["PCV5"][-1],
+        "DEPARTAMENTO": CATS["DEPARTAMENTO"][-1],
+        "AREA": CATS["AREA"][-1],
         "cluster_k4": 3,
         "n_personas": 4,
-        "indice_calidad_vivienda": df["indice_calidad_vivienda"].quantile(0.75),
+        "indice_calidad_vivienda": ICV_STATS["q75"],
     },
     "esc_3_vivienda_intermedia": {
-        "PCV2": df["PCV2"].dropna().astype("category").cat.categories[1],
-        "PCV3": df["PCV3"].dropna().astype("category").cat.categories[1],
-        "PCV5": df["PCV5"].dropna().astype("category").cat.categories[1],
-        "DEPARTAMENTO": df["DEPARTAMENTO"].dropna().astype("category").cat.categories[5],
-        "AREA": df["AREA"].dropna().astype("category").cat.categories[0],
+        "PCV2": CATS["PCV2"][1],
+        "PCV3": CATS["PCV3"][1],
+        "PCV5": CATS["PCV5"][1],
+        "DEPARTAMENTO": CATS["DEPARTAMENTO"][5],
+        "AREA": CATS["AREA"][0],
         "cluster_k4": 2,
         "n_personas": 5,
-        "indice_calidad_vivienda": df["indice_calidad_vivienda"].median(),
+        "indice_calidad_vivienda": ICV_STATS["median"],
     },
 }
 
@@ -587,6 +1056,8 @@ predecir_escenarios(
     dir_reports=DIR_REPORTS,
 )
 
+plt.close(FIG_CURVAS)
+
 print("==============================================================")
 print(" FASE 9 COMPLETADA — MODELOS DE REDES NEURONALES LISTOS")
 print("==============================================================\n")